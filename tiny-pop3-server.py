@@ -32,21 +32,41 @@ DEFAULT_PASSWORD = 'pass'
 import Tkinter as T
 import tkFileDialog
 import hashlib
-import StringIO
+import itertools
+import cStringIO
+from collections import deque
+
+# Prefer the epoll reactor where available (Linux). It has to be installed
+# before anything imports twisted.internet.reactor.
+try:
+	from twisted.internet import epollreactor
+	epollreactor.install()
+except ImportError:
+	pass
 
-import twisted.mail.pop3
 from twisted.internet import tksupport, reactor
+from twisted.internet.defer import DeferredList
+from twisted.internet.threads import deferToThread
 from twisted.cred.portal import Portal, IRealm
 from twisted.internet.protocol import ServerFactory
-from twisted.mail.pop3 import IMailbox
+from twisted.mail.pop3 import IMailbox, POP3, successResponse
 from twisted.cred.checkers import InMemoryUsernamePasswordDatabaseDontUse
 from zope.interface import implements
 
 EVENT_MAILBOXCHANGE = '<<mailboxchange>>'
 EVENT_MESSAGELOGCHANGE = '<<messagelogchange>>'
 
+# Coalesce bursts of GUI events: fire each event at most once per delay.
+EVENT_DELAY = 0.05
+
+# Keep only this many lines of protocol log, so that long sessions do not
+# grow the log (and the log view) without bounds.
+MESSAGELOG_MAXLEN = 50000
+
 root = None
-messagelog = []
+messagelog = deque(maxlen=MESSAGELOG_MAXLEN)
+messagelog_total = 0
+pending_events = {EVENT_MAILBOXCHANGE: False, EVENT_MESSAGELOGCHANGE: False}
 
 class Service:
 	def __init__(self):
@@ -55,91 +75,146 @@ class Service:
 		self.listeningPort = None
 		self.username = DEFAULT_USERNAME
 		self.password = DEFAULT_PASSWORD
+		self.log_enabled = True
 
 def emit_event(event):
+	if pending_events[event]:
+		return
+	pending_events[event] = True
+	reactor.callLater(EVENT_DELAY, flush_event, event)
+
+def flush_event(event):
 	#print "Emitting event {}".format(event)
+	pending_events[event] = False
 	root.event_generate(event, when='tail')
 
-def incoming_line(line):
-	messagelog.append("C: " + line.strip("\n\r"))
+def log_line(line):
+	global messagelog_total
+	messagelog.append(line)
+	messagelog_total += 1
 	emit_event(EVENT_MESSAGELOGCHANGE)
 
+def read_file(filename):
+	print "Opening file '{}'".format(filename)
+	# Messages are byte streams, avoid newline translation.
+	f = open(filename, 'rb')
+	try:
+		return f.read()
+	finally:
+		f.close()
+
+def incoming_line(line):
+	log_line("C: " + line.rstrip("\r\n"))
+
 def outgoing_line(line):
-	messagelog.append("S: " + line.strip("\n\r"))
-	emit_event(EVENT_MESSAGELOGCHANGE)
+	log_line("S: " + line.rstrip("\r\n"))
+
+# Use a class for each message we store in the mailbox. Mailboxes can hold
+# lots of messages, so skip the per-instance __dict__.
+class Message(object):
+	__slots__ = ('__content', '__label', '__deleted', '__uidl', '__display')
 
-# Use a class for each message we store in the mailbox.
-class Message:
 	def __init__(self, content=None, label=None):
+		# Messages are stored as raw bytes: that is what we hash for UIDL
+		# and what we send to the client.
+		if isinstance(content, unicode):
+			content = content.encode('utf-8')
 		self.__content = content
 		self.__label = label
 		self.__deleted = False
+		self.__uidl = None
+		self.__display = None
 
 	def content(self):
 		return self.__content
 
+	# The content never changes, so compute the digest only once.
+	def uidl(self):
+		if self.__uidl is None:
+			self.__uidl = hashlib.sha1(self.__content).hexdigest()
+		return self.__uidl
+
 	def label(self):
-		label = None
-		if self.__label:
-			label = '' + self.__label
-		if self.deleted() and label:
-			label = label + ' (deleted)'
-		return label
+		if self.__label and self.__deleted:
+			return self.__label + ' (deleted)'
+		return self.__label
+
+	# Text shown in the GUI message list. Cached together with the message
+	# number, which changes when deleted messages are removed.
+	def display(self, idx):
+		if self.__display is None or self.__display[0] != idx:
+			label = self.label()
+			if label:
+				text = "Message {}: {}".format(idx, label)
+			else:
+				text = "Message {}".format(idx)
+			self.__display = (idx, text)
+		return self.__display[1]
 
 	def deleted(self):
 		return self.__deleted
 
 	def delete(self):
 		self.__deleted = True
+		self.__display = None
 
 	def undelete(self):
 		self.__deleted = False
+		self.__display = None
 
 class Mailbox:
 	implements(IMailbox)
 
+	# The message sizes are kept in a list parallel to the messages, so that
+	# LIST and STAT do not need to look at every message.
 	def __init__(self):
 		self.messages = []
+		self.sizes = []
+
+	# Let the list do the bounds checking, but do not accept negative indices
+	# wrapping around to the end of the mailbox.
+	def _check(self, seq, index):
+		if index < 0:
+			raise ValueError
+		try:
+			return seq[index]
+		except IndexError:
+			raise ValueError
+
+	def message(self, index):
+		return self._check(self.messages, index)
 
 	def listMessages(self, index=None):
 		if index is None:
-			return [len(m.content()) for m in self.messages]
-		if index >= len(self.messages):
-			raise ValueError
-		return len(self.messages[index].content())
+			return self.sizes[:]
+		return self._check(self.sizes, index)
 
 	def getMessage(self, index):
-		if index >= len(self.messages):
-			raise ValueError
-		return StringIO.StringIO(self.messages[index].content())
+		# A cStringIO created from a string reads from it without copying.
+		return cStringIO.StringIO(self.message(index).content())
 
 	def getUidl(self, index):
-		if index >= len(self.messages):
-			raise ValueError
-		return hashlib.sha1(self.messages[index].content()).hexdigest()
+		return self.message(index).uidl()
 
 	def deleteMessage(self, index):
-		if index >= len(self.messages):
-			raise ValueError
-		self.messages[index].delete()
+		self.message(index).delete()
 		emit_event(EVENT_MAILBOXCHANGE)
 
 	def undeleteMessages(self):
-		if index >= len(self.messages):
-			raise ValueError
-		self.messages[index].undelete()
+		for m in self.messages:
+			m.undelete()
 		emit_event(EVENT_MAILBOXCHANGE)
 
 	def sync(self):
-		keep = []
-		for message in self.messages:
-			if not message.deleted():
-				keep.append(message)
-		self.messages = keep
+		keep = [(m, size) for m, size in zip(self.messages, self.sizes)
+				if not m.deleted()]
+		self.messages = [m for m, size in keep]
+		self.sizes = [size for m, size in keep]
 		emit_event(EVENT_MAILBOXCHANGE)
 
 	def addMessage(self, msg):
 		self.messages.append(msg)
+		self.sizes.append(len(msg.content()))
 		emit_event(EVENT_MAILBOXCHANGE)
 
 class SimpleRealm:
@@ -155,23 +230,32 @@ class SimpleRealm:
 
 # I want to log all traffic between the client and the server. Use our own
 # server class to get the most interesting events from the twisted framework.
-class POP3Server(twisted.mail.pop3.POP3):
+class POP3Server(POP3):
 
 	# Could show something in the UI to indicate a connected client:
 	#def connectionMade(self):
-	#twisted.mail.pop3.POP3.connectionMade(self)
-
+	#POP3.connectionMade(self)
+
+	# Logging can be turned off from the GUI, e.g. for bulk transfers.
+	#
+	# Note that twisted writes the body of RETR and TOP responses directly to
+	# the transport, without going through sendLine(), so only the status
+	# line and the terminating '.' show up in the log. Full LIST and UIDL
+	# responses, status line included, bypass the log completely.
 	def successResponse(self, message=''):
-		outgoing_line(twisted.mail.pop3.successResponse(message))
-		twisted.mail.pop3.POP3.successResponse(self, message)
+		if self.service.log_enabled:
+			outgoing_line(successResponse(message))
+		POP3.successResponse(self, message)
 
 	def lineReceived(self, line):
-		incoming_line(line)
-		twisted.mail.pop3.POP3.lineReceived(self, line)
+		if self.service.log_enabled:
+			incoming_line(line)
+		POP3.lineReceived(self, line)
 
 	def sendLine(self, line):
-		outgoing_line(line)
-		twisted.mail.pop3.POP3.sendLine(self, line)
+		if self.service.log_enabled:
+			outgoing_line(line)
+		POP3.sendLine(self, line)
 
 class GUI:
 	class HScrollList(T.Frame):
@@ -197,6 +281,9 @@ class GUI:
 		self.mailbox = mailbox
 		self.service = service
 		self.message_generate_count = 0
+		self.message_log_count = 0
+		self.message_log_refresh_pending = False
+		self.message_shown = None
 
 		master.title("POP3 Server {}:{}".format(service.interface, service.port))
 
@@ -213,7 +300,7 @@ class GUI:
 
 		self.message_list = GUI.HScrollList(message_list_frame)
 		self.message_list.pack(expand=T.YES, fill=T.BOTH)
-		self.message_list.list.bind('<Button-1>', self.display_message)
+		self.message_list.list.bind('<<ListboxSelect>>', self.display_message)
 		master.bind(EVENT_MAILBOXCHANGE, self.refresh_message_list)
 
 		self.add_message_button = T.Button(message_list_frame,
@@ -239,12 +326,23 @@ class GUI:
 		self.message_log_content.pack(expand=T.YES, fill=T.BOTH)
 		master.bind(EVENT_MESSAGELOGCHANGE, self.refresh_message_log_content)
 
+		self.log_enabled = T.BooleanVar()
+		self.log_enabled.set(service.log_enabled)
+		self.log_enabled_button = T.Checkbutton(message_log_frame,
+				text='Log protocol messages',
+				variable=self.log_enabled,
+				command=self.toggle_log)
+		self.log_enabled_button.pack(side=T.TOP, anchor=T.W)
+
 	def add_message(self):
 		self.message_generate_count += 1
 		m = Message("Hi there!\nGenerated message number {} goes here.\n"
 				.format(self.message_generate_count))
 		self.mailbox.addMessage(m)
 
+	def toggle_log(self):
+		self.service.log_enabled = self.log_enabled.get()
+
 	def import_message(self):
 		filenames = tkFileDialog.askopenfilenames()
 		if not filenames:
@@ -254,34 +352,61 @@ class GUI:
 		filenames = self.master.tk.splitlist(filenames)
 		print "Importing files: {}".format(filenames)
 
-		for filename in filenames:
-			print "Opening file '{}'".format(filename)
-			f = open(filename)
-			content = f.read()
-			f.close()
-			#print "MESSAGE: {}".format(content)
-			self.mailbox.addMessage(Message(content, f.name))
+		# Files can be big, read them in threads to keep the reactor (and
+		# the GUI) responsive. DeferredList keeps the results in order.
+		d = DeferredList([deferToThread(read_file, filename)
+				for filename in filenames], consumeErrors=True)
+		d.addCallback(self.import_message_done, filenames)
+
+	def import_message_done(self, results, filenames):
+		for (success, result), filename in zip(results, filenames):
+			if not success:
+				print "Failed to import '{}': {}".format(filename,
+						result.getErrorMessage())
+				continue
+			#print "MESSAGE: {}".format(result)
+			self.mailbox.addMessage(Message(result, filename))
 
 	def refresh_message_list(self, event=None):
-		self.message_list.list.delete(0, T.END)
-		for idx in range(1, len(self.mailbox.messages)+1):
-			if self.mailbox.messages[idx-1].label():
-				label = "Message {}: {}".format(idx,
-					self.mailbox.messages[idx-1].label())
-			else:
-				label = "Message {}".format(idx)
-			self.message_list.list.insert(T.END, label)
-
+		labels = [m.display(idx)
+				for idx, m in enumerate(self.mailbox.messages, 1)]
+		# Insert all entries with a single Tcl call.
+		lst = self.message_list.list
+		lst.delete(0, T.END)
+		lst.insert(T.END, *labels)
+		# The list index may now refer to a different message.
+		self.message_shown = None
+
+	# Update the view when Tk is idle, so that all log changes since the last
+	# update are handled together.
 	def refresh_message_log_content(self, event=None):
-		self.message_log_content.text.delete('0.0', T.END)
-		for message in messagelog:
-			self.message_log_content.text.insert(T.END, message)
-			self.message_log_content.text.insert(T.END, "\n")
+		if self.message_log_refresh_pending:
+			return
+		self.message_log_refresh_pending = True
+		self.message_log_content.text.after_idle(self.update_message_log_content)
+
+	# Append just the lines we have not shown yet, and drop the oldest lines
+	# from the view as they fall out of the message log.
+	def update_message_log_content(self):
+		self.message_log_refresh_pending = False
+		text = self.message_log_content.text
+		count = min(messagelog_total - self.message_log_count, len(messagelog))
+		if count:
+			batch = itertools.islice(messagelog, len(messagelog) - count, None)
+			text.insert(T.END, "\n".join(batch) + "\n")
+		self.message_log_count = messagelog_total
+		lines = int(text.index('end-1c').split('.')[0]) - 1
+		if lines > MESSAGELOG_MAXLEN:
+			text.delete('1.0', '{}.0'.format(lines - MESSAGELOG_MAXLEN + 1))
 
 	def display_message(self, event):
-		if len(self.mailbox.messages) == 0:
+		selection = self.message_list.list.curselection()
+		if not selection:
+			return
+		message_num = int(selection[0])
+		if message_num == self.message_shown:
 			return
-		message_num = self.message_list.list.nearest(event.y)
+		self.message_shown = message_num
 		self.messagecontent.text.delete('0.0', T.END)
 		self.messagecontent.text.insert('0.0',
 			self.mailbox.messages[message_num].content())
@@ -297,6 +422,7 @@ if __name__ == '__main__':
 	f = ServerFactory()
 	f.protocol = POP3Server
 	f.protocol.portal = portal
+	f.protocol.service = service
 
 	print "Starting to listen on {}:{}...".format(service.interface, service.port)
 	service.listeningPort = reactor.listenTCP(port=service.port, factory=f, interface=service.interface)